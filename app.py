@@ -1,14 +1,17 @@
 
 import json
-import re
-import hashlib
+from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
 
-import altair as alt
-import pandas as pd
 import streamlit as st
 from st_cytoscape import cytoscape
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 st.set_page_config(page_title='Course Pathways', layout='wide')
 
 st.markdown(
@@ -57,88 +60,286 @@ NODE_BORDER = '#111827'
 TERMINALS = {'Graduate', 'Leave School'}
 
 
-@st.cache_data
+@st.cache_data(persist='disk', show_spinner=False)
 def load_school_graph(school_name: str) -> dict:
-    return json.loads(SCHOOL_FILES[school_name].read_text(encoding='utf-8'))
+    path = SCHOOL_FILES[school_name]
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    return json.loads(path.read_text(encoding='utf-8'))
+
+
+@st.cache_data
+def build_track_index(school_name: str) -> dict:
+    graph = load_school_graph(school_name)
+    course_to_tracks = {}
+    for t, courses in graph['tracks'].items():
+        for c in dict.fromkeys(courses):
+            course_to_tracks.setdefault(c, []).append(t)
+    return {c: tuple(ts) for c, ts in course_to_tracks.items()}
+
+
+def node_tracks(course: str, course_to_tracks: dict) -> tuple:
+    return course_to_tracks.get(course, ())
+
+
+def primary_track(course: str, course_to_tracks: dict):
+    return course_to_tracks.get(course, (None,))[0]
+
+
+def edge_tracks(src: str, dst: str, edge_track_names: dict) -> tuple:
+    return edge_track_names.get((src, dst), ())
+
+
+@st.cache_data
+def edge_track_index(school_name: str) -> dict:
+    graph = load_school_graph(school_name)
+    course_to_tracks = build_track_index(school_name)
+    index = {}
+    for (s, t, p) in graph['edges']:
+        src_t = frozenset(course_to_tracks.get(s, ()))
+        dst_t = frozenset(course_to_tracks.get(t, ()))
+        index[(s, t)] = tuple(sorted((src_t & dst_t) or (src_t | dst_t)))
+    return index
+
+
+@st.cache_data
+def track_masks(school_name: str) -> dict:
+    graph = load_school_graph(school_name)
+    course_to_tracks = build_track_index(school_name)
+    track_bit = {t: 1 << i for i, t in enumerate(graph['tracks'])}
+    course_mask = {c: sum(track_bit[t] for t in ts) for c, ts in course_to_tracks.items()}
+    edge_mask = {}
+    for (s, t, p) in graph['edges']:
+        src_m = course_mask.get(s, 0)
+        dst_m = course_mask.get(t, 0)
+        edge_mask[(s, t)] = (src_m & dst_m) or (src_m | dst_m)
+    return {'track_bit': track_bit, 'course': course_mask, 'edge': edge_mask}
 
 
-def node_tracks(course: str, tracks: dict) -> list:
-    return [t for t, courses in tracks.items() if course in set(courses)]
+@st.cache_data
+def adjacency(school_name: str) -> dict:
+    graph = load_school_graph(school_name)
+    incoming = defaultdict(list)
+    outgoing = defaultdict(list)
+    loops = {}
+    neighbors = defaultdict(set)
+    incident = defaultdict(set)
+    edge_p = {}
+    for (s, t, p) in graph['edges']:
+        if s == t:
+            loops.setdefault(s, float(p))
+        else:
+            outgoing[s].append((t, float(p)))
+            incoming[t].append((s, float(p)))
+        for c in (s, t):
+            neighbors[c].update([s, t])
+            incident[c].add(f'{s}→{t}')
+        edge_p.setdefault(f'{s}→{t}', float(p))
+
+    def top6(items):
+        return sorted(items, key=lambda x: -x[1])[:6]
 
+    return {
+        'loops': loops,
+        'top_in': {c: top6(v) for c, v in incoming.items()},
+        'top_out': {c: top6(v) for c, v in outgoing.items()},
+        'neighbors': dict(neighbors),
+        'incident': dict(incident),
+        'edge_p': edge_p,
+    }
 
-def primary_track(course: str, tracks: dict):
-    for t, courses in tracks.items():
-        if course in set(courses):
-            return t
-    return None
 
+class _SlugTable(dict):
+    def __missing__(self, key):
+        return '_'
 
-def edge_tracks(src: str, dst: str, tracks: dict) -> list:
-    src_t = set(node_tracks(src, tracks))
-    dst_t = set(node_tracks(dst, tracks))
-    inter = sorted(src_t.intersection(dst_t))
-    return inter if inter else sorted(src_t.union(dst_t))
 
+_SLUG_TABLE = _SlugTable({ord(c): c for c in 'abcdefghijklmnopqrstuvwxyz0123456789'})
 
+
+@lru_cache(maxsize=4096)
 def _slugify(s: str) -> str:
-    s = s.strip().lower()
-    s = re.sub(r'[^a-z0-9]+', '_', s)
-    s = re.sub(r'_+', '_', s).strip('_')
-    return s or 'node'
+    s = s.strip().lower().translate(_SLUG_TABLE)
+    while '__' in s:
+        s = s.replace('__', '_')
+    return s.strip('_') or 'node'
 
 
 def make_unique_ids(courses: list[str]) -> tuple[dict, dict]:
     course_to_uid = {}
     used = set()
+    counts = {}
     for c in courses:
         base = _slugify(c)
+        # Resume from the last suffix handed out for this slug; the loop only
+        # spins when a suffixed id collides with another course's own slug.
+        k = counts.get(base, 1)
         uid = base
-        if uid in used:
-            h = hashlib.md5(c.encode('utf-8')).hexdigest()[:8]
-            uid = f"{base}_{h}"
-        k = 2
         while uid in used:
-            uid = f"{base}_{k}"
             k += 1
+            uid = f"{base}_{k}"
+        counts[base] = k
         used.add(uid)
         course_to_uid[c] = uid
     uid_to_course = {v: k for k, v in course_to_uid.items()}
     return course_to_uid, uid_to_course
 
 
-def get_self_loop_p(graph: dict, course: str) -> float | None:
-    for s, t, p in graph['edges']:
-        if s == course and t == course:
-            return float(p)
-    return None
+@st.cache_data
+def uid_maps(school_name: str) -> tuple[dict, dict, dict]:
+    graph = load_school_graph(school_name)
+    course_to_uid, uid_to_course = make_unique_ids(graph['nodes'])
+    edge_uid_to_course = {f"{course_to_uid[s]}→{course_to_uid[t]}": f"{s}→{t}" for (s, t, p) in graph['edges']}
+    return course_to_uid, uid_to_course, edge_uid_to_course
+
+
+@st.cache_data
+def node_positions(school_name: str) -> tuple[dict, list]:
+    graph = load_school_graph(school_name)
+    saved = graph.get('positions', {})
+    positions = {c: {'x': saved[c][0], 'y': saved[c][1]} for c in graph['nodes'] if c in saved}
+    missing = [c for c in graph['nodes'] if c not in saved]
+
+    # The map uses the preset layout, so every class needs a position. Classes
+    # missing from the file are stacked in a column right of the saved ones.
+    x = max((p['x'] for p in positions.values()), default=0) + 200
+    for i, course in enumerate(missing):
+        positions[course] = {'x': x, 'y': i * 130}
+    return positions, missing
+
+
+@st.cache_data
+def node_base(school_name: str) -> dict:
+    graph = load_school_graph(school_name)
+    course_to_tracks = build_track_index(school_name)
+    course_to_uid, _, _ = uid_maps(school_name)
+    positions, _ = node_positions(school_name)
+    base = {}
+    for course in graph['nodes']:
+        base[course] = {
+            'uid': course_to_uid[course],
+            'fill': TRACK_COLORS.get(primary_track(course, course_to_tracks), '#2B2D42'),
+            'position': positions[course],
+        }
+    return base
+
+
+@st.cache_data
+def edge_base(school_name: str) -> dict:
+    graph = load_school_graph(school_name)
+    course_to_uid, _, _ = uid_maps(school_name)
+    sources = [course_to_uid[s] for (s, t, p) in graph['edges']]
+    targets = [course_to_uid[t] for (s, t, p) in graph['edges']]
+    course_eids = [f'{s}→{t}' for (s, t, p) in graph['edges']]
+    return {
+        'sources': sources,
+        'targets': targets,
+        'uid_eids': [f'{a}→{b}' for a, b in zip(sources, targets)],
+        'course_eids': course_eids,
+    }
+
+
+@st.cache_data
+def color_key_html(school_name: str) -> str:
+    graph = load_school_graph(school_name)
+    return '\n'.join(
+        "- <span style='display:inline-block;width:12px;height:12px;background:{};border:1px solid #111827;margin-right:10px;'></span> {}".format(
+            TRACK_COLORS.get(t, '#2B2D42'), t
+        )
+        for t in graph['tracks'].keys()
+    )
 
 
 def friendly_percent(x: float) -> str:
     return f"{x * 100:.0f}%"
 
 
-def course_panel(graph: dict, course: str):
-    tracks = graph['tracks']
+GENDER_ROWS = [
+    {'Group': 'Girls', 'Share': 0.52},
+    {'Group': 'Boys', 'Share': 0.48},
+]
+
+RACE_ROWS = [
+    {'Group': 'Black', 'Share': 0.28},
+    {'Group': 'Latine', 'Share': 0.18},
+    {'Group': 'White', 'Share': 0.44},
+    {'Group': 'Asian', 'Share': 0.10},
+]
+
+BOTH_ROWS = [
+    {'Gender': 'Girls', 'Race': 'Black', 'Share': 0.15},
+    {'Gender': 'Girls', 'Race': 'Latine', 'Share': 0.10},
+    {'Gender': 'Girls', 'Race': 'White', 'Share': 0.22},
+    {'Gender': 'Girls', 'Race': 'Asian', 'Share': 0.05},
+    {'Gender': 'Boys', 'Race': 'Black', 'Share': 0.13},
+    {'Gender': 'Boys', 'Race': 'Latine', 'Share': 0.08},
+    {'Gender': 'Boys', 'Race': 'White', 'Share': 0.22},
+    {'Gender': 'Boys', 'Race': 'Asian', 'Share': 0.05},
+]
+
+
+def share_bar_spec(rows: list[dict], height: int) -> dict:
+    return {
+        'data': {'values': rows},
+        'mark': {'type': 'bar', 'cornerRadiusTopRight': 6, 'cornerRadiusBottomRight': 6},
+        'encoding': {
+            'x': {'field': 'Share', 'type': 'quantitative', 'axis': {'format': '%'}, 'title': 'Share of students'},
+            'y': {'field': 'Group', 'type': 'nominal', 'sort': '-x', 'title': ''},
+            'tooltip': [{'field': 'Share', 'type': 'quantitative', 'format': '.0%'}],
+        },
+        'height': height,
+    }
+
+
+GENDER_SPEC = share_bar_spec(GENDER_ROWS, height=220)
+RACE_SPEC = share_bar_spec(RACE_ROWS, height=240)
+BOTH_SPEC = {
+    'data': {'values': BOTH_ROWS},
+    'mark': {'type': 'rect', 'cornerRadius': 6},
+    'encoding': {
+        'x': {'field': 'Race', 'type': 'nominal', 'title': 'Race'},
+        'y': {'field': 'Gender', 'type': 'nominal', 'title': 'Gender'},
+        'color': {'field': 'Share', 'type': 'quantitative', 'title': 'Share', 'scale': {'scheme': 'blues'}},
+        'tooltip': [
+            {'field': 'Gender', 'type': 'nominal'},
+            {'field': 'Race', 'type': 'nominal'},
+            {'field': 'Share', 'type': 'quantitative', 'format': '.0%'},
+        ],
+    },
+    'height': 180,
+}
+
+
+@st.cache_data(show_spinner=False)
+def compute_panel_data(school_name: str, course: str) -> dict:
+    adj = adjacency(school_name)
+    return {
+        'tracks': node_tracks(course, build_track_index(school_name)),
+        'loop_p': adj['loops'].get(course),
+        'incoming': adj['top_in'].get(course, []),
+        'outgoing': adj['top_out'].get(course, []),
+    }
+
+
+def course_panel(school_name: str, course: str):
+    data = compute_panel_data(school_name, course)
 
     st.subheader(course)
 
-    tlist = node_tracks(course, tracks)
+    tlist = data['tracks']
     st.write('**Path group:** ' + (', '.join(tlist) if tlist else 'Not listed'))
 
-    loop_p = get_self_loop_p(graph, course)
+    loop_p = data['loop_p']
     if loop_p is not None and loop_p > 0:
         st.write(f"**Repeat this class next year:** {friendly_percent(loop_p)}")
 
-    incoming = [(s, p) for (s, t, p) in graph['edges'] if t == course and s != course]
-    outgoing = [(t, p) for (s, t, p) in graph['edges'] if s == course and t != course]
-
-    def fmt(items):
-        return sorted(items, key=lambda x: -x[1])
+    incoming = data['incoming']
+    outgoing = data['outgoing']
 
     st.markdown('---')
     st.write('### What students do next')
     if outgoing:
-        for dst, p in fmt(outgoing)[:6]:
+        for dst, p in outgoing:
             st.write(f"- **{dst}**: {friendly_percent(float(p))}")
     else:
         st.write('No next-step arrows from this class.')
@@ -146,7 +347,7 @@ def course_panel(graph: dict, course: str):
     st.markdown('---')
     st.write('### Where students come from')
     if incoming:
-        for src, p in fmt(incoming)[:6]:
+        for src, p in incoming:
             st.write(f"- **{src}**: {friendly_percent(float(p))}")
     else:
         st.write('No arrows pointing into this class.')
@@ -159,184 +360,174 @@ def course_panel(graph: dict, course: str):
 
     with tab_gender:
         st.write('**Gender (placeholder)**')
-        gender_df = pd.DataFrame([
-            {'Group': 'Girls', 'Share': 0.52},
-            {'Group': 'Boys', 'Share': 0.48},
-        ])
-        gender_chart = (
-            alt.Chart(gender_df)
-            .mark_bar(cornerRadiusTopRight=6, cornerRadiusBottomRight=6)
-            .encode(
-                x=alt.X('Share:Q', axis=alt.Axis(format='%'), title='Share of students'),
-                y=alt.Y('Group:N', sort='-x', title=''),
-                tooltip=[alt.Tooltip('Share:Q', format='.0%')],
-            )
-            .properties(height=220)
-        )
-        st.altair_chart(gender_chart, width='stretch')
+        st.vega_lite_chart(GENDER_SPEC, width='stretch')
 
     with tab_race:
         st.write('**Race (placeholder)**')
-        race_df = pd.DataFrame([
-            {'Group': 'Black', 'Share': 0.28},
-            {'Group': 'Latine', 'Share': 0.18},
-            {'Group': 'White', 'Share': 0.44},
-            {'Group': 'Asian', 'Share': 0.10},
-        ])
-        race_chart = (
-            alt.Chart(race_df)
-            .mark_bar(cornerRadiusTopRight=6, cornerRadiusBottomRight=6)
-            .encode(
-                x=alt.X('Share:Q', axis=alt.Axis(format='%'), title='Share of students'),
-                y=alt.Y('Group:N', sort='-x', title=''),
-                tooltip=[alt.Tooltip('Share:Q', format='.0%')],
-            )
-            .properties(height=240)
-        )
-        st.altair_chart(race_chart, width='stretch')
+        st.vega_lite_chart(RACE_SPEC, width='stretch')
 
     with tab_both:
         st.write('**Gender × Race (placeholder)**')
         st.write('This is an “intersection”: we look at two things at the same time.')
+        st.vega_lite_chart(BOTH_SPEC, width='stretch')
+
+
+@st.cache_resource
+def base_elements(school_name: str) -> list:
+    graph = load_school_graph(school_name)
+    nodes = node_base(school_name)
+    edges = edge_base(school_name)
+
+    elements = []
+
+    for course in graph['nodes']:
+        base = nodes[course]
+        node_el = {
+            'data': {
+                'id': base['uid'],
+                'label': course,
+                'bg': base['fill'],
+                'opacity': 1.0,
+                'border': NODE_BORDER,
+                'borderWidth': 2,
+            },
+            'classes': '',
+            'position': base['position'],
+        }
+        elements.append(node_el)
+
+    for i, (s, t, p) in enumerate(graph['edges']):
+        is_self = (s == t)
+
+        edge_data = {
+            'id': edges['uid_eids'][i],
+            'source': edges['sources'][i],
+            'target': edges['targets'][i],
+            'color': EDGE_COLOR,
+            'opacity': 0.85,
+        }
+        if is_self:
+            edge_data['label'] = friendly_percent(float(p))
+        elements.append({'data': edge_data, 'classes': 'selfloop' if is_self else ''})
+
+    return elements
 
-        both_df = pd.DataFrame([
-            {'Gender': 'Girls', 'Race': 'Black', 'Share': 0.15},
-            {'Gender': 'Girls', 'Race': 'Latine', 'Share': 0.10},
-            {'Gender': 'Girls', 'Race': 'White', 'Share': 0.22},
-            {'Gender': 'Girls', 'Race': 'Asian', 'Share': 0.05},
-            {'Gender': 'Boys', 'Race': 'Black', 'Share': 0.13},
-            {'Gender': 'Boys', 'Race': 'Latine', 'Share': 0.08},
-            {'Gender': 'Boys', 'Race': 'White', 'Share': 0.22},
-            {'Gender': 'Boys', 'Race': 'Asian', 'Share': 0.05},
-        ])
-
-        heat = (
-            alt.Chart(both_df)
-            .mark_rect(cornerRadius=6)
-            .encode(
-                x=alt.X('Race:N', title='Race'),
-                y=alt.Y('Gender:N', title='Gender'),
-                color=alt.Color('Share:Q', title='Share', scale=alt.Scale(scheme='blues')),
-                tooltip=['Gender', 'Race', alt.Tooltip('Share:Q', format='.0%')],
-            )
-            .properties(height=180)
-        )
-        st.altair_chart(heat, width='stretch')
 
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_cytoscape_elements(school_name: str, selected_node: str | None, selected_edge: str | None):
+    # base_elements is shared, so only the elements the focus changes are cloned.
+    elements = list(base_elements(school_name))
+    if not (selected_node or selected_edge):
+        return elements
 
-def build_cytoscape_elements(graph: dict, selected_node: str | None, selected_edge: str | None,
-                             course_to_uid: dict, uid_to_course: dict):
-    tracks = graph['tracks']
-    positions = graph.get('positions', {})
+    graph = load_school_graph(school_name)
+    course_to_tracks = build_track_index(school_name)
+    edge_track_names = edge_track_index(school_name)
+    edges = edge_base(school_name)
 
     focus_tracks = set()
     focus_neighbors = set()
     focus_edges = set()
 
     if selected_node:
-        focus_tracks.update(node_tracks(selected_node, tracks))
-        for (s, t, p) in graph['edges']:
-            if s == selected_node or t == selected_node:
-                focus_neighbors.update([s, t])
-                focus_edges.add(f'{s}→{t}')
+        focus_tracks.update(node_tracks(selected_node, course_to_tracks))
+        adj = adjacency(school_name)
+        focus_neighbors.update(adj['neighbors'].get(selected_node, ()))
+        focus_edges.update(adj['incident'].get(selected_node, ()))
 
     if selected_edge:
         try:
             s, t = selected_edge.split('→')
-            focus_tracks.update(edge_tracks(s, t, tracks))
+            focus_tracks.update(edge_tracks(s, t, edge_track_names))
             focus_neighbors.update([s, t])
             focus_edges.add(selected_edge)
         except Exception:
             pass
 
-    focus_mode = bool(selected_node or selected_edge)
+    masks = track_masks(school_name)
+    focus_mask = 0
+    for t in focus_tracks:
+        focus_mask |= masks['track_bit'].get(t, 0)
+    course_mask = masks['course']
+    edge_mask = masks['edge']
 
-    elements = []
+    n_nodes = len(graph['nodes'])
 
-    for course in graph['nodes']:
-        t_primary = primary_track(course, tracks)
-        fill = TRACK_COLORS.get(t_primary, '#2B2D42')
-        opacity = 1.0
-        border_width = 2
-        classes = []
+    for i, course in enumerate(graph['nodes']):
+        in_focus_track = course_mask.get(course, 0) & focus_mask
+        is_dim = (not in_focus_track) and (course not in focus_neighbors)
+        is_selected = selected_node == course
+        if not (is_dim or is_selected):
+            continue
 
-        if focus_mode:
-            course_track_list = node_tracks(course, tracks)
-            in_focus_track = any(t in focus_tracks for t in course_track_list)
-            is_neighbor = course in focus_neighbors
-            if (not in_focus_track) and (not is_neighbor):
-                fill = DIM_COLOR
-                opacity = 0.18
-                classes.append('dim')
-
-        if selected_node == course:
-            border_width = 6
+        data = dict(elements[i]['data'])
+        classes = []
+        if is_dim:
+            data['bg'] = DIM_COLOR
+            data['opacity'] = 0.18
+            classes.append('dim')
+        if is_selected:
+            data['borderWidth'] = 6
             classes.append('selected')
+        elements[i] = {**elements[i], 'data': data, 'classes': ' '.join(classes)}
+
+    # focus_edges holds exactly the edges touching the selected node plus the
+    # selected edge, which are also the ones that get a visible label.
+    for i, (s, t, p), course_eid in zip(range(n_nodes, len(elements)), graph['edges'], edges['course_eids']):
+        if s == t:
+            continue
+
+        data = dict(elements[i]['data'])
+        edge_el = elements[i] = {**elements[i], 'data': data}
+
+        is_focus_edge = course_eid in focus_edges
+        if is_focus_edge:
+            data['label'] = friendly_percent(float(p))
+
+        if is_focus_edge or edge_mask[(s, t)] & focus_mask:
+            data['color'] = EDGE_HIGHLIGHT
+            data['opacity'] = 1.0
+            edge_el['classes'] = 'focus'
+        else:
+            data['color'] = DIM_COLOR
+            data['opacity'] = 0.10
+            edge_el['classes'] = 'dim'
 
-        uid = course_to_uid[course]
-        node_el = {
-            'data': {
-                'id': uid,
-                'label': course,
-                'bg': fill,
-                'opacity': opacity,
-                'border': NODE_BORDER,
-                'borderWidth': border_width,
-            },
-            'classes': ' '.join(classes),
-        }
-        if course in positions:
-            x, y = positions[course]
-            node_el['position'] = {'x': x, 'y': y}
-        elements.append(node_el)
+    return elements
 
-    for (s, t, p) in graph['edges']:
-        src_uid = course_to_uid[s]
-        dst_uid = course_to_uid[t]
-        uid_eid = f'{src_uid}→{dst_uid}'
-        course_eid = f'{s}→{t}'
 
-        is_self = (s == t)
+def clear_selection():
+    st.session_state.selected_node = None
+    st.session_state.selected_edge = None
 
-        show_label = is_self
-        if (not is_self) and selected_node and (s == selected_node or t == selected_node):
-            show_label = True
-        if (not is_self) and selected_edge and course_eid == selected_edge:
-            show_label = True
 
-        opacity = 0.85
-        ecolor = EDGE_COLOR
-        classes = []
-        if is_self:
-            classes.append('selfloop')
-
-        if focus_mode and not is_self:
-            etracks = edge_tracks(s, t, tracks)
-            in_focus = bool(set(etracks).intersection(focus_tracks)) or (course_eid in focus_edges)
-            if in_focus:
-                ecolor = EDGE_HIGHLIGHT
-                opacity = 1.0
-                classes.append('focus')
-            else:
-                ecolor = DIM_COLOR
-                opacity = 0.10
-                classes.append('dim')
-
-        label_txt = friendly_percent(float(p)) if show_label else ''
-
-        elements.append({
-            'data': {
-                'id': uid_eid,
-                'source': src_uid,
-                'target': dst_uid,
-                'label': label_txt,
-                'color': ecolor,
-                'opacity': opacity,
-            },
-            'classes': ' '.join(classes),
-        })
+def render_detail(school_name: str):
+    st.header('Details')
 
-    return elements
+    if st.session_state.selected_node:
+        course_panel(school_name, st.session_state.selected_node)
+
+    elif st.session_state.selected_edge:
+        st.subheader('Arrow details')
+        try:
+            s, t = st.session_state.selected_edge.split('→')
+            st.write(f'**From:** {s}')
+            st.write(f'**To:** {t}')
+        except Exception:
+            st.write(st.session_state.selected_edge)
+            s = t = None
+
+        p = adjacency(school_name)['edge_p'].get(st.session_state.selected_edge)
+        if p is not None:
+            st.write(f'**Chance:** {friendly_percent(p)}')
+
+        if s and t and s != t:
+            et = edge_tracks(s, t, edge_track_index(school_name))
+            if et:
+                st.write('**Path colors involved:** ' + ', '.join(et))
+
+    else:
+        st.write('Click a circle or an arrow to see more information here.')
 
 
 with st.sidebar:
@@ -344,7 +535,7 @@ with st.sidebar:
     st.write('This map shows how students move from one math class to the next.')
     st.write('Tap a circle to see details on the right.')
 
-    school = st.selectbox('Choose a school', list(SCHOOL_FILES.keys()), index=0)
+    school = st.selectbox('Choose a school', list(SCHOOL_FILES.keys()), index=0, on_change=clear_selection)
 
     st.markdown('---')
     st.subheader('Filters')
@@ -353,31 +544,17 @@ with st.sidebar:
     st.selectbox('Race', ['All'], disabled=True)
     st.selectbox('Gender', ['All'], disabled=True)
 
-    gtmp = load_school_graph(school)
     st.markdown('---')
     st.subheader('Color key')
     st.write('Colors show different course paths.')
-    for t in gtmp['tracks'].keys():
-        st.markdown(
-            "- <span style='display:inline-block;width:12px;height:12px;background:{};border:1px solid #111827;margin-right:10px;'></span> {}".format(
-                TRACK_COLORS.get(t, '#2B2D42'), t
-            ),
-            unsafe_allow_html=True,
-        )
-
-
-left, right = st.columns([0.68, 0.32], gap='large')
+    st.markdown(color_key_html(school), unsafe_allow_html=True)
 
-graph = load_school_graph(school)
 
 if 'selected_node' not in st.session_state:
     st.session_state.selected_node = None
 if 'selected_edge' not in st.session_state:
     st.session_state.selected_edge = None
 
-course_to_uid, uid_to_course = make_unique_ids(graph['nodes'])
-edge_uid_to_course = {f"{course_to_uid[s]}→{course_to_uid[t]}": f"{s}→{t}" for (s, t, p) in graph['edges']}
-
 stylesheet = [
     {
         'selector': 'node',
@@ -405,7 +582,6 @@ stylesheet = [
             'line-color': 'data(color)',
             'opacity': 'data(opacity)',
             'width': 3,
-            'label': 'data(label)',
             'font-size': 16,
             'color': '#111827',
             'text-background-color': '#FFFFFF',
@@ -414,6 +590,7 @@ stylesheet = [
             'z-index': 0,
         },
     },
+    {'selector': 'edge[label]', 'style': {'label': 'data(label)'}},
     {
         'selector': 'edge.selfloop',
         'style': {
@@ -434,79 +611,56 @@ stylesheet = [
     {'selector': '.selected', 'style': {'border-width': 6}},
 ]
 
-with left:
-    st.header('Math class map')
-    st.write('Circles are classes. Arrows show where students go next.')
-    st.write('A looped arrow means some students repeat the same class.')
-    st.write('"Graduate" and "Leave School" are endings, so they have no arrows going out.')
-
-    elements = build_cytoscape_elements(
-        graph,
-        st.session_state.selected_node,
-        st.session_state.selected_edge,
-        course_to_uid,
-        uid_to_course,
-    )
-
-    selected = cytoscape(
-        elements,
-        stylesheet,
-        width='100%',
-        height='740px',
-        layout={'name': 'preset', 'animationDuration': 0},
-        selection_type='single',
-        user_zooming_enabled=True,
-        user_panning_enabled=True,
-        key='cy_graph',
-    )
 
-    clicked_nodes = selected.get('nodes', []) if isinstance(selected, dict) else []
-    clicked_edges = selected.get('edges', []) if isinstance(selected, dict) else []
+@st.fragment
+def render_main(school_name: str):
+    _, uid_to_course, edge_uid_to_course = uid_maps(school_name)
+    left, right = st.columns([0.68, 0.32], gap='large')
 
-    if clicked_nodes:
-        uid = clicked_nodes[0]
-        st.session_state.selected_node = uid_to_course.get(uid)
-        st.session_state.selected_edge = None
-    elif clicked_edges:
-        uid_eid = clicked_edges[0]
-        st.session_state.selected_edge = edge_uid_to_course.get(uid_eid)
-        st.session_state.selected_node = None
+    with left:
+        st.header('Math class map')
+        st.write('Circles are classes. Arrows show where students go next.')
+        st.write('A looped arrow means some students repeat the same class.')
+        st.write('"Graduate" and "Leave School" are endings, so they have no arrows going out.')
 
-    if st.button('Clear selection'):
-        st.session_state.selected_node = None
-        st.session_state.selected_edge = None
-        st.rerun()
+        _, missing_positions = node_positions(school_name)
+        if missing_positions:
+            st.caption('No saved map position for: ' + ', '.join(missing_positions) + '. These are placed on the right.')
 
+        elements = build_cytoscape_elements(
+            school_name,
+            st.session_state.selected_node,
+            st.session_state.selected_edge,
+        )
 
-with right:
-    st.header('Details')
+        selected = cytoscape(
+            elements,
+            stylesheet,
+            width='100%',
+            height='740px',
+            layout={'name': 'preset', 'animationDuration': 0},
+            selection_type='single',
+            user_zooming_enabled=True,
+            user_panning_enabled=True,
+            key=f'cy_{school_name}',
+        )
 
-    if st.session_state.selected_node:
-        course_panel(graph, st.session_state.selected_node)
+        clicked_nodes = selected.get('nodes', []) if isinstance(selected, dict) else []
+        clicked_edges = selected.get('edges', []) if isinstance(selected, dict) else []
 
-    elif st.session_state.selected_edge:
-        st.subheader('Arrow details')
-        try:
-            s, t = st.session_state.selected_edge.split('→')
-            st.write(f'**From:** {s}')
-            st.write(f'**To:** {t}')
-        except Exception:
-            st.write(st.session_state.selected_edge)
-            s = t = None
+        if clicked_nodes:
+            uid = clicked_nodes[0]
+            st.session_state.selected_node = uid_to_course.get(uid)
+            st.session_state.selected_edge = None
+        elif clicked_edges:
+            uid_eid = clicked_edges[0]
+            st.session_state.selected_edge = edge_uid_to_course.get(uid_eid)
+            st.session_state.selected_node = None
 
-        p = None
-        for (ss, tt, pp) in graph['edges']:
-            if f'{ss}→{tt}' == st.session_state.selected_edge:
-                p = float(pp)
-                break
+        st.button('Clear selection', on_click=clear_selection)
 
-        if p is not None:
-            st.write(f'**Chance:** {friendly_percent(p)}')
+    with right:
+        render_detail(school_name)
 
-        if s and t and s != t:
-            et = edge_tracks(s, t, graph['tracks'])
-            if et:
-                st.write('**Path colors involved:** ' + ', '.join(et))
 
-    else:
-        st.write('Click a circle or an arrow to see more information here.')
+render_main(school)